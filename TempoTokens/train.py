@@ -26,7 +26,7 @@ from tqdm.auto import tqdm
 
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import set_seed
+from accelerate.utils import set_seed, DataLoaderConfiguration
 
 from models.unet_3d_condition import UNet3DConditionModel
 from diffusers.models import AutoencoderKL
@@ -44,7 +44,7 @@ from modules.beats.BEATs import BEATs, BEATsConfig
 from modules.temp_tokens.embedder import TempEmbedder
 from modules.text_encoder.modeling_clip_tempotokens import CLIPTextModel, CLIPEncoder
 from utils.dataset import VideoJsonDataset, SingleVideoDataset, \
-    ImageDataset, VideoFolderDataset, CachedDataset
+    ImageDataset, VideoFolderDataset, CachedDataset, pinned_collate, reset_worker_caches
 from einops import rearrange
 
 from utils.lora import (
@@ -475,7 +475,8 @@ def handle_cache_latents(
 
                 for k, v in batch.items(): batch[k] = v[0]
 
-                torch.save(batch, full_out_path)
+                # Plain dict so torch.load(weights_only=True) can read it back.
+                torch.save(dict(batch), full_out_path)
                 del pixel_values
                 del batch
 
@@ -487,11 +488,15 @@ def handle_cache_latents(
     else:
         cache_save_dir = cached_latent_dir
 
+    # This loader replaces train_dataloader and goes through accelerator.prepare, whose
+    # non_blocking dataloader_config makes the copy from these pinned batches asynchronous.
     return torch.utils.data.DataLoader(
         CachedDataset(cache_dir=cache_save_dir),
         batch_size=train_batch_size,
         shuffle=True,
-        num_workers=0
+        num_workers=0,
+        collate_fn=pinned_collate,
+        pin_memory=True
     )
 
 
@@ -670,6 +675,8 @@ def main(
         extra_unet_params=None,
         extra_text_encoder_params=None,
         train_batch_size: int = 1,
+        num_workers: int = 0,
+        prefetch_factor: int = 2,
         max_train_steps: int = 500,
         learning_rate: float = 5e-5,
         lora_learning_rate: float = 5e-5,
@@ -718,7 +725,9 @@ def main(
         gradient_accumulation_steps=gradient_accumulation_steps,
         mixed_precision=mixed_precision,
         log_with=log_with,
-        project_dir=output_dir
+        project_dir=output_dir,
+        # Batches come from pinned buffers (see pinned_collate), so let the prepared dataloaders copy them asynchronously.
+        dataloader_config=DataLoaderConfiguration(non_blocking=True)
     )
 
     # Make one log on every process with the configuration for debugging.
@@ -827,7 +836,12 @@ def main(
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=train_batch_size,
-        shuffle=True
+        shuffle=True,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        worker_init_fn=reset_worker_caches,
+        collate_fn=pinned_collate,
+        pin_memory=True
     )
 
     # Latents caching
@@ -966,7 +980,7 @@ def main(
         # Encode text embeddings
         token_ids = batch['prompt_ids']
 
-        audio_values = batch['audio_values'].to('cuda')
+        audio_values = batch['audio_values']
         audio_features = beats.extract_features(audio_values)[1]
 
         temporal_token, local_window_1, local_window_2, local_window_3, local_window_4, audio_token = at_embedder(audio_features)
@@ -1,28 +1,90 @@
 import os
 import decord
+import av
 import numpy as np
 import random
 import json
-import torchvision
-import torchvision.transforms as T
 import torch
-import torchaudio
-import pandas as pd
+import torch.nn.functional as F
+import soundfile
 import pickle
+import functools
 
-from glob import glob
 from PIL import Image
 from itertools import islice
-from pathlib import Path
-
-from transformers import AutoProcessor
 
 from .bucketing import sensible_buckets
 
 decord.bridge.set_bridge('torch')
 
 from torch.utils.data import Dataset
-from einops import rearrange, repeat
+
+try:
+    from torchcodec.decoders import VideoDecoder
+except ImportError:
+    VideoDecoder = None
+
+@functools.lru_cache(maxsize=64)
+def _get_vr(path, w=-1, h=-1):
+    # Decord's reader init dominates short-clip decode, so keep readers alive per process.
+    # Inside DataLoader workers each reader gets one thread, since the workers already decode in parallel.
+    # In the main process decord picks the thread count itself.
+    num_threads = 1 if torch.utils.data.get_worker_info() is not None else 0
+    return decord.VideoReader(path, width=w, height=h, num_threads=num_threads)
+
+def reset_worker_caches(worker_id):
+    # Pass as the DataLoader's worker_init_fn. Forked workers inherit the parent's cached readers,
+    # and sharing one file offset between processes corrupts concurrent seeks.
+    _get_vr.cache_clear()
+    _get_decoder.cache_clear()
+
+@functools.lru_cache(maxsize=None)
+def _get_frame_shape(path):
+    # (height, width) from the container header, without decoding a frame.
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        return stream.height, stream.width
+
+def probe_video_meta(path):
+    # (num_frames, fps) from the container header, without opening a decoder.
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate)
+        num_frames = stream.frames
+
+        if not num_frames:
+            if stream.duration is not None:
+                duration = float(stream.duration * stream.time_base)
+            else:
+                duration = container.duration / av.time_base
+            num_frames = int(round(duration * fps))
+
+    return num_frames, fps
+
+def _dump_pickle(obj, path):
+    # Write to a private temp file and swap it in, so concurrent writers never leave a torn file.
+    tmp_path = f"{path}.{os.getpid()}"
+    with open(tmp_path, "wb") as file:
+        pickle.dump(obj, file)
+    os.replace(tmp_path, path)
+
+def pinned_collate(batch):
+    # Copy each example straight into one preallocated batch tensor, so the batch is never built
+    # with torch.stack and then copied again for pinning. Forked workers can't allocate pinned
+    # memory (it needs CUDA), so there the DataLoader's pin-memory thread pins the batch instead.
+    pin = torch.cuda.is_available() and torch.utils.data.get_worker_info() is None
+
+    collated = {}
+    for key, value in batch[0].items():
+        if isinstance(value, torch.Tensor):
+            out = torch.empty((len(batch),) + value.shape, dtype=value.dtype, pin_memory=pin)
+            for i, example in enumerate(batch):
+                out[i].copy_(example[key])
+            collated[key] = out
+        else:
+            collated[key] = [example[key] for example in batch]
+
+    return collated
 
 def get_prompt_ids(prompt, tokenizer):
     prompt_ids = tokenizer(
@@ -35,6 +97,35 @@ def get_prompt_ids(prompt, tokenizer):
 
     return prompt_ids
 
+def build_prompt_cache(prompts, tokenizer):
+    # Tokenize every unique prompt in one batched call, keyed by prompt string.
+    prompts = list(dict.fromkeys(prompts))
+    if tokenizer is None or len(prompts) == 0:
+        return {}
+
+    prompt_ids = get_prompt_ids(prompts, tokenizer)
+    return {prompt: ids.unsqueeze(0) for prompt, ids in zip(prompts, prompt_ids)}
+
+def get_cached_prompt_ids(prompt_cache, prompt, tokenizer):
+    if prompt not in prompt_cache:
+        prompt_cache[prompt] = get_prompt_ids(prompt, tokenizer)
+
+    return prompt_cache[prompt]
+
+@functools.lru_cache(maxsize=None)
+def _make_resize(height, width):
+    # One resize callable per bucket size, shared by every dataset and sample.
+    return functools.partial(resize_frames, size=(height, width))
+
+def resize_frames(frames, size):
+    # Bilinear without antialiasing. It is much cheaper than the antialiased Resize on CPU
+    # and works on the whole clip at once.
+    return F.interpolate(frames.float(), size=size, mode='bilinear', align_corners=False, antialias=False)
+
+def normalize_frames(frames):
+    # Cast once, then scale and shift in place, instead of allocating two temporaries.
+    return frames.to(torch.float32).mul_(1.0 / 127.5).sub_(1.0)
+
 def read_caption_file(caption_file):
         with open(caption_file, 'r', encoding="utf8") as t:
             return t.read()
@@ -72,37 +163,153 @@ def get_text_prompt(
     
 def get_video_frames(vr, start_idx, sample_rate=1, max_frames=24):
     max_range = len(vr)
-    frame_number = sorted((0, start_idx, max_range))[1]
-
-    frame_range = range(frame_number, max_range, sample_rate)
-    frame_range_indices = list(frame_range)[:max_frames]
+    frame_number = min(max(0, start_idx), max_range)
+    end = min(max_range, frame_number + max_frames * sample_rate)
 
-    return frame_range_indices
+    return np.arange(frame_number, end, sample_rate, dtype=np.int64)
 
-def process_video(vid_path, use_bucketing, w, h, get_frame_buckets, get_frame_batch):
+def process_video(vid_path, use_bucketing, w, h, get_frame_buckets, get_frame_batch, use_audio=True):
     if use_bucketing:
-        vr = decord.VideoReader(vid_path)
-        resize = get_frame_buckets(vr)
-        video, idxs = get_frame_batch(vr, resize=resize)
+        vr = _get_vr(vid_path)
+        vr.seek(0)
+        resize = get_frame_buckets(vid_path)
+        video, idxs = get_frame_batch(vr, vid_path, resize=resize)
 
     else:
-        vr = decord.VideoReader(vid_path, width=w, height=h)
-        video, idxs = get_frame_batch(vr)
+        vr = _get_vr(vid_path, w, h)
+        vr.seek(0)
+        video, idxs = get_frame_batch(vr, vid_path)
+
+    audio = load_audio_window(get_audio_path(vid_path), idxs) if use_audio else None
+
+    return video, vr, audio
+
+def get_audio_path(vid_path):
+    return vid_path.replace('video', 'audio').replace('mp4', 'wav')
+
+def decode_clip(path, indices, out_h, out_w):
+    # Seek to the keyframe at or before the first requested frame, then decode only up to the last one.
+    # libswscale (via PyAV's reformat) does the YUV -> RGB conversion and the bilinear resize in one
+    # pass per frame, so no full-resolution RGB copy is made.
+    positions = {}
+    for pos, idx in enumerate(indices):
+        positions.setdefault(int(idx), []).append(pos)
+    first_idx, last_idx = min(positions), max(positions)
+
+    frames = [None] * len(indices)
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        # Same rule as _get_vr: single-threaded inside DataLoader workers, since they already decode in parallel.
+        if torch.utils.data.get_worker_info() is None:
+            stream.thread_type = 'AUTO'
+
+        fps = float(stream.average_rate)
+        start_pts = stream.start_time or 0
+        if first_idx > 0:
+            container.seek(
+                start_pts + int(first_idx / fps / stream.time_base), stream=stream, backward=True, any_frame=False
+            )
 
-    aud_path = vid_path.replace('video', 'audio').replace('mp4', 'wav')
-    waveform, sample_rate = torchaudio.load(aud_path)
+        for frame in container.decode(stream):
+            if frame.pts is None: continue
 
-    waveform = torch.tile(waveform, (1, 10))
-    audio = waveform[:, :sample_rate * 10]
+            # After a seek, frame numbers have to come from the timestamp rather than from a decode counter.
+            i = int(round(float((frame.pts - start_pts) * stream.time_base) * fps))
+            if i in positions:
+                rgb = frame.reformat(
+                    width=out_w, height=out_h, format='rgb24', interpolation='BILINEAR'
+                ).to_ndarray()
+                for pos in positions[i]: frames[pos] = rgb
+            if i >= last_idx: break
+
+    if any(frame is None for frame in frames):
+        raise IndexError(f"Couldn't decode frames {list(indices)} from {path}")
+
+    return torch.from_numpy(np.stack(frames)).permute(0, 3, 1, 2)
+
+@functools.lru_cache(maxsize=64)
+def _get_decoder(path):
+    # Same per-process reuse as _get_vr. Approximate seek mode trusts the container index
+    # instead of scanning the whole file on open.
+    if VideoDecoder is None:
+        raise ImportError("decode_backend='torchcodec' requires the torchcodec package.")
+
+    return VideoDecoder(path, seek_mode='approximate')
+
+def decode_frames_torchcodec(path, indices, out_h, out_w):
+    decoder = _get_decoder(path)
+    video = decoder.get_frames_at(indices=[int(idx) for idx in indices]).data
+
+    if video.shape[-2:] != (out_h, out_w):
+        video = resize_frames(video, (out_h, out_w))
+    return video
+
+def _decode_frames(path, idxs, h, w, backend):
+    # The non-decord backends. Both return (f, c, h, w) frames already at the target size.
+    if backend == 'torchcodec':
+        return decode_frames_torchcodec(path, idxs, h, w)
+
+    return decode_clip(path, idxs, h, w)
+
+def load_audio_window(aud_path, idxs):
+    # Read only the samples that line up with the sampled frames.
+    # Clips shorter than the window are looped, capped at 10 seconds, as before.
+    info = soundfile.info(aud_path)
+    sample_rate, num_samples = info.samplerate, info.frames
 
     start = int(sample_rate * (idxs[0])/30)
     end = start + int(len(idxs)/24 * sample_rate)
-    audio = audio[:, start:end]
+    end = min(end, sample_rate * 10, num_samples * 10)
 
-    return video, vr, audio
+    if end <= num_samples:
+        waveform, _ = soundfile.read(
+            aud_path, start=start, frames=max(0, end - start), dtype='float32', always_2d=True
+        )
+    else:
+        waveform, _ = soundfile.read(aud_path, dtype='float32', always_2d=True)
+        waveform = np.tile(waveform, (-(-end // num_samples), 1))[start:end]
+
+    return torch.from_numpy(waveform.T).contiguous()
+
+class _VideoMixin:
+    # Shared frame sampling for the video datasets. Subclasses provide get_frame_idxs(vr, vid_path)
+    # and the width, height and use_bucketing attributes.
+    use_audio = False
+
+    def get_frame_size(self, vid_path):
+        if not self.use_bucketing:
+            return self.height, self.width
+
+        h, w = _get_frame_shape(vid_path)
+        width, height = sensible_buckets(self.width, self.height, w, h)
+
+        return height, width
+
+    def get_frame_buckets(self, vid_path):
+        return _make_resize(*self.get_frame_size(vid_path))
+
+    def get_frame_batch(self, vr, vid_path, resize=None):
+        idxs = self.get_frame_idxs(vr, vid_path)
+        video = vr.get_batch(idxs).permute(0, 3, 1, 2)
+
+        if resize is not None: video = resize(video)
+        return video, idxs
+
+    def process_video_wrapper(self, vid_path):
+        video, vr, audio = process_video(
+                vid_path,
+                self.use_bucketing,
+                self.width,
+                self.height,
+                self.get_frame_buckets,
+                self.get_frame_batch,
+                use_audio=self.use_audio
+            )
+
+        return video, vr, audio
 
 # https://github.com/ExponentialML/Video-BLIP2-Preprocessor
-class VideoJsonDataset(Dataset):
+class VideoJsonDataset(_VideoMixin, Dataset):
     def __init__(
             self,
             tokenizer = None,
@@ -133,28 +340,23 @@ class VideoJsonDataset(Dataset):
         self.sample_start_idx = sample_start_idx
         self.frame_step = frame_step
 
+        prompts = [data['prompt'] for data in self.train_data] if self.train_data is not None else []
+        self._prompt_cache = build_prompt_cache(prompts, self.tokenizer)
+
     def build_json(self, json_data):
-        extended_data = []
-        for data in json_data['data']:
-            for nested_data in data['data']:
-                self.build_json_dict(
-                    data, 
-                    nested_data, 
-                    extended_data
-                )
-        json_data = extended_data
-        return json_data
-
-    def build_json_dict(self, data, nested_data, extended_data):
-        clip_path = nested_data['clip_path'] if 'clip_path' in nested_data else None
-        
-        extended_data.append({
-            self.vid_data_key: data[self.vid_data_key],
-            'frame_index': nested_data['frame_index'],
-            'prompt': nested_data['prompt'],
-            'clip_path': clip_path
-        })
-        
+        # Flatten every nested clip entry in one pass.
+        vid_data_key = self.vid_data_key
+        return [
+            {
+                vid_data_key: data[vid_data_key],
+                'frame_index': nested_data['frame_index'],
+                'prompt': nested_data['prompt'],
+                'clip_path': nested_data.get('clip_path')
+            }
+            for data in json_data['data']
+            for nested_data in data['data']
+        ]
+
     def load_from_json(self, path, json_data):
         try:
             with open(path) as jpath:
@@ -170,7 +372,7 @@ class VideoJsonDataset(Dataset):
     def validate_json(self, base_path, path):
         return os.path.exists(f"{base_path}/{path}")
 
-    def get_frame_range(self, vr):
+    def get_frame_idxs(self, vr, vid_path=None):
         return get_video_frames(
             vr, 
             self.sample_start_idx, 
@@ -188,33 +390,6 @@ class VideoJsonDataset(Dataset):
 
         return idx
 
-    def get_frame_buckets(self, vr):
-        _, h, w = vr[0].shape        
-        width, height = sensible_buckets(self.width, self.height, h, w)
-        resize = T.transforms.Resize((height, width), antialias=True)
-
-        return resize
-
-    def get_frame_batch(self, vr, resize=None):
-        frame_range = self.get_frame_range(vr)
-        frames = vr.get_batch(frame_range)
-        video = rearrange(frames, "f h w c -> f c h w")
-
-        if resize is not None: video = resize(video)
-        return video
-
-    def process_video_wrapper(self, vid_path):
-        video, vr = process_video(
-                vid_path,
-                self.use_bucketing,
-                self.width, 
-                self.height, 
-                self.get_frame_buckets, 
-                self.get_frame_batch
-            )
-        
-        return video, vr 
-
     def train_data_batch(self, index):
 
         # If we are training on individual clips.
@@ -228,9 +403,9 @@ class VideoJsonDataset(Dataset):
             # Get video prompt
             prompt = vid_data['prompt']
 
-            video, _ = self.process_video_wrapper(clip_path)
+            video, _, _ = self.process_video_wrapper(clip_path)
 
-            prompt_ids = get_prompt_ids(prompt, self.tokenizer)
+            prompt_ids = get_cached_prompt_ids(self._prompt_cache, prompt, self.tokenizer)
 
             return video, prompt, prompt_ids
 
@@ -243,13 +418,13 @@ class VideoJsonDataset(Dataset):
         # Initialize resize
         resize = None
 
-        video, vr = self.process_video_wrapper(train_data[self.vid_data_key])
+        video, vr, _ = self.process_video_wrapper(train_data[self.vid_data_key])
 
         # Get video prompt
         prompt = train_data['prompt']
         vr.seek(0)
 
-        prompt_ids = get_prompt_ids(prompt, self.tokenizer)
+        prompt_ids = get_cached_prompt_ids(self._prompt_cache, prompt, self.tokenizer)
 
         return video, prompt, prompt_ids
 
@@ -274,7 +449,7 @@ class VideoJsonDataset(Dataset):
             video, prompt, prompt_ids = self.train_data_batch(index)
 
         example = {
-            "pixel_values": (video / 127.5 - 1.0),
+            "pixel_values": normalize_frames(video),
             "prompt_ids": prompt_ids[0],
             "text_prompt": prompt,
             'dataset': self.__getname__()
@@ -283,7 +458,7 @@ class VideoJsonDataset(Dataset):
         return example
 
 
-class SingleVideoDataset(Dataset):
+class SingleVideoDataset(_VideoMixin, Dataset):
     def __init__(
         self,
             tokenizer = None,
@@ -311,20 +486,21 @@ class SingleVideoDataset(Dataset):
 
         self.width = width
         self.height = height
+
+        self._prompt_cache = build_prompt_cache([self.single_video_prompt], self.tokenizer)
+
     def create_video_chunks(self):
         # Create a list of frames separated by sample frames
         # [(1,2,3), (4,5,6), ...]
+        # __len__ runs this in the DataLoader's parent process, so don't leave a reader in the cache for workers to inherit.
         vr = decord.VideoReader(self.single_video_path)
         vr_range = range(1, len(vr), self.frame_step)
 
-        self.frames = list(self.chunk(vr_range, self.n_sample_frames))
-
-        # Delete any list that contains an out of range index.
-        for i, inner_frame_nums in enumerate(self.frames):
-            for frame_num in inner_frame_nums:
-                if frame_num > len(vr):
-                    print(f"Removing out of range index list at position: {i}...")
-                    del self.frames[i]
+        # Drop any chunk that contains an out of range index.
+        num_frames = len(vr)
+        self.frames = [
+            chunk for chunk in self.chunk(vr_range, self.n_sample_frames) if max(chunk) < num_frames
+        ]
 
         return self.frames
 
@@ -332,42 +508,18 @@ class SingleVideoDataset(Dataset):
         it = iter(it)
         return iter(lambda: tuple(islice(it, size)), ())
 
-    def get_frame_batch(self, vr, resize=None):
-        index = self.index
-        frames = vr.get_batch(self.frames[self.index])
-        video = rearrange(frames, "f h w c -> f c h w")
-
-        if resize is not None: video = resize(video)
-        return video
-
-    def get_frame_buckets(self, vr):
-        _, h, w = vr[0].shape        
-        width, height = sensible_buckets(self.width, self.height, h, w)
-        resize = T.transforms.Resize((height, width), antialias=True)
-
-        return resize
-    
-    def process_video_wrapper(self, vid_path):
-        video, vr = process_video(
-                vid_path,
-                self.use_bucketing,
-                self.width, 
-                self.height, 
-                self.get_frame_buckets, 
-                self.get_frame_batch
-            )
-        
-        return video, vr 
+    def get_frame_idxs(self, vr, vid_path=None):
+        return self.frames[self.index]
 
     def single_video_batch(self, index):
         train_data = self.single_video_path
         self.index = index
 
         if train_data.endswith(self.vid_types):
-            video, _ = self.process_video_wrapper(train_data)
+            video, _, _ = self.process_video_wrapper(train_data)
 
             prompt = self.single_video_prompt
-            prompt_ids = get_prompt_ids(prompt, self.tokenizer)
+            prompt_ids = get_cached_prompt_ids(self._prompt_cache, prompt, self.tokenizer)
 
             return video, prompt, prompt_ids
         else:
@@ -385,7 +537,7 @@ class SingleVideoDataset(Dataset):
         video, prompt, prompt_ids = self.single_video_batch(index)
 
         example = {
-            "pixel_values": (video / 127.5 - 1.0),
+            "pixel_values": normalize_frames(video),
             "prompt_ids": prompt_ids[0],
             "text_prompt": prompt,
             'dataset': self.__getname__()
@@ -407,11 +559,13 @@ class ImageDataset(Dataset):
         single_img_prompt: str = '',
         use_bucketing: bool = False,
         fallback_prompt: str = '',
+        gpu_decode: bool = False,
         **kwargs
     ):
         self.tokenizer = tokenizer
         self.img_types = (".png", ".jpg", ".jpeg", '.bmp')
         self.use_bucketing = use_bucketing
+        self.gpu_decode = gpu_decode
 
         self.image_dir = self.get_images_list(image_dir)
         self.fallback_prompt = fallback_prompt
@@ -422,6 +576,10 @@ class ImageDataset(Dataset):
         self.width = width
         self.height = height
 
+        # Resolve every caption once so __getitem__ never touches the filesystem for prompts.
+        self._prompt_map = {img: self.get_image_prompt(img) for img in self.image_dir}
+        self._prompt_cache = build_prompt_cache(self._prompt_map.values(), self.tokenizer)
+
     def get_images_list(self, image_dir):
         if os.path.exists(image_dir):
             imgs = [x for x in os.listdir(image_dir) if x.endswith(self.img_types)]
@@ -434,14 +592,49 @@ class ImageDataset(Dataset):
 
         return ['']
 
-    def image_batch(self, index):
-        train_data = self.image_dir[index]
-        img = train_data
+    def get_image_prompt(self, img_path):
+        return get_text_prompt(
+            file_path=img_path,
+            text_prompt=self.single_img_prompt,
+            fallback_prompt=self.fallback_prompt,
+            ext_types=self.img_types,
+            use_caption=True
+        )
+
+    def use_gpu_decode(self, img_path):
+        # nvJPEG needs CUDA, which forked DataLoader workers can't initialize, so only the main process uses it.
+        return (
+            self.gpu_decode
+            and img_path.lower().endswith(('.jpg', '.jpeg'))
+            and torch.cuda.is_available()
+            and torch.utils.data.get_worker_info() is None
+        )
+
+    def read_image(self, img_path):
+        # Imported here so workers for the video datasets don't pay for torchvision.
+        import torchvision
+        import torchvision.transforms as T
+
+        if self.use_gpu_decode(img_path):
+            try:
+                data = torchvision.io.read_file(img_path)
+                return torchvision.io.decode_jpeg(data, mode=torchvision.io.ImageReadMode.RGB, device='cuda')
+            except torch.cuda.OutOfMemoryError:
+                raise
+            except RuntimeError:
+                # nvJPEG rejects some JPEGs (e.g. CMYK); decode those on the CPU.
+                pass
 
         try:
-            img = torchvision.io.read_image(img, mode=torchvision.io.ImageReadMode.RGB)
+            return torchvision.io.read_image(img_path, mode=torchvision.io.ImageReadMode.RGB)
         except:
-            img = T.transforms.PILToTensor()(Image.open(img).convert("RGB"))
+            return T.transforms.PILToTensor()(Image.open(img_path).convert("RGB"))
+
+    def image_batch(self, index):
+        import torchvision.transforms as T
+
+        train_data = self.image_dir[index]
+        img = self.read_image(train_data)
 
         width = self.width
         height = self.height
@@ -452,17 +645,11 @@ class ImageDataset(Dataset):
               
         resize = T.transforms.Resize((height, width), antialias=True)
 
-        img = resize(img) 
-        img = repeat(img, 'c h w -> f c h w', f=1)
+        img = resize(img).cpu()
+        img = img.unsqueeze(0)
 
-        prompt = get_text_prompt(
-            file_path=train_data,
-            text_prompt=self.single_img_prompt,
-            fallback_prompt=self.fallback_prompt,
-            ext_types=self.img_types,  
-            use_caption=True
-        )
-        prompt_ids = get_prompt_ids(prompt, self.tokenizer)
+        prompt = self._prompt_map.get(train_data, self.fallback_prompt)
+        prompt_ids = get_cached_prompt_ids(self._prompt_cache, prompt, self.tokenizer)
 
         return img, prompt, prompt_ids
 
@@ -479,7 +666,7 @@ class ImageDataset(Dataset):
     def __getitem__(self, index):
         img, prompt, prompt_ids = self.image_batch(index)
         example = {
-            "pixel_values": (img / 127.5 - 1.0),
+            "pixel_values": normalize_frames(img),
             "prompt_ids": prompt_ids[0],
             "text_prompt": prompt, 
             'dataset': self.__getname__()
@@ -487,7 +674,12 @@ class ImageDataset(Dataset):
 
         return example
 
-class VideoFolderDataset(Dataset):
+class VideoFolderDataset(_VideoMixin, Dataset):
+    use_audio = True
+    # Failed attempts before a never-loaded index is skipped for the rest of the run.
+    max_load_failures = 3
+    decode_backends = ('decord', 'pyav', 'torchcodec')
+
     def __init__(
         self,
         tokenizer=None,
@@ -501,8 +693,13 @@ class VideoFolderDataset(Dataset):
         labels=['playing bass guitar'],
         data_set='train',
         repeat=5,
+        approximate_sampling: bool = False,
+        decode_backend: str = 'decord',
         **kwargs
     ):
+        if decode_backend not in self.decode_backends:
+            raise ValueError(f"decode_backend must be one of {self.decode_backends}, got {decode_backend!r}.")
+
         self.new = True
         self.repeat = repeat
         self.data_dir = path
@@ -513,7 +710,9 @@ class VideoFolderDataset(Dataset):
         self.filter_low_quality_imgs = True
         self.video_files = list()
         self.labels = labels
-        self.valid_videos = set()
+        self.bad_videos_path = f"{path}/.bad_videos.txt"
+
+        import pandas as pd
 
         self.df = pd.read_csv(f'datasets/{kwargs["dataset_name"]}.csv')
         self.df = self.df[self.df["set"] == self.data_set]
@@ -534,108 +733,293 @@ class VideoFolderDataset(Dataset):
             class_counts = self.df['class'].value_counts()
             self.df = self.df[self.df['class'].isin(class_counts.index[class_counts >= 120])]
 
-        videos = set([file_path[:-4] for file_path in os.listdir(f"{path}/video/")])
-        audios = set([file_path[:-4] for file_path in os.listdir(f"{path}/audio/")])
-        samples = videos & audios
+        # Skip videos that failed to load in earlier runs.
+        samples, caption_names = self.list_samples(path)
+        samples = samples - self.load_bad_videos()
 
         self.prepare_dataset(samples)
 
+        self.fallback_prompt = fallback_prompt
+        self._prompt_map = self.build_prompt_map(path, caption_names)
+        prompts = [self.get_video_prompt(vid_path) for vid_path in self.video_files]
+        self._prompt_cache = build_prompt_cache(prompts, self.tokenizer)
+
         self.video_files = self.video_files * self.repeat
+        self.reset_sample_masks()
 
         self.width = width
         self.height = height
 
         self.n_sample_frames = n_sample_frames
         self.fps = fps
+        self.approximate_sampling = approximate_sampling
+        self.decode_backend = decode_backend
 
-        self.fallback_prompt = fallback_prompt
+    def up_sample(self):
+        import pandas as pd
 
-        # self.processor = AutoProcessor.from_pretrained("MIT/ast-finetuned-audioset-10-10-0.4593")
+        # Nothing matched the filters, so there is nothing to balance (pd.concat of no frames raises).
+        if self.df.empty:
+            return
 
-    def up_sample(self):
+        # Step 1: Find the maximum count of any class
+        max_class_count = self.df['class'].value_counts().max()
 
-        # Step 1: Calculate the count of each class
-        class_counts = self.df['class'].value_counts()
+        # Step 2: Randomly sample (with replacement) the missing rows of every class, then concatenate once
+        upsampled_df = pd.concat(
+            [group.sample(n=max_class_count - len(group), replace=True) for _, group in self.df.groupby('class')],
+            ignore_index=True
+        )
 
-        # Step 2: Find the maximum count of any class
-        max_class_count = class_counts.max()
+        # Step 3: Combine the original DataFrame and upsampled DataFrame to create the balanced DataFrame
+        self.df = pd.concat([self.df, upsampled_df], ignore_index=True)
 
-        # Step 3: Create an empty DataFrame to store upsampled rows
-        upsampled_df = pd.DataFrame(columns=self.df.columns)
+    def list_samples(self, path):
+        # Listing large video/audio folders is slow, so the matched names (and the names of the .txt
+        # captions in video/) are cached next to the data. The cache is invalidated whenever either
+        # folder's mtime changes (i.e. files were added or removed).
+        video_dir, audio_dir = f"{path}/video/", f"{path}/audio/"
+        key = (os.stat(video_dir).st_mtime_ns, os.stat(audio_dir).st_mtime_ns)
+        cache_path = f"{path}/.samples_index.pkl"
 
-        # Step 4: Upsample all classes to match the count of the maximum class
-        for class_name, group in self.df.groupby('class'):
-            if len(group) < max_class_count:
-                # Calculate the number of samples to upsample for this class
-                num_samples_to_add = max_class_count - len(group)
-                # Randomly sample with replacement to upsample
-                upsampled_samples = group.sample(n=num_samples_to_add, replace=True)
-                # Append the upsampled samples to the upsampled DataFrame
-                upsampled_df = pd.concat([upsampled_df, upsampled_samples], ignore_index=True)
+        try:
+            with open(cache_path, "rb") as file:
+                cached_key, samples, caption_names = pickle.load(file)
+            if cached_key == key:
+                return samples, caption_names
+        except Exception:
+            pass
+
+        videos, caption_names = set(), set()
+        for entry in os.scandir(video_dir):
+            if entry.name.endswith('.mp4'):
+                videos.add(entry.name[:-4])
+            elif entry.name.endswith('.txt'):
+                caption_names.add(entry.name[:-4])
+
+        audios = {entry.name[:-4] for entry in os.scandir(audio_dir) if entry.name.endswith('.wav')}
+        samples = videos & audios
 
-        # Step 5: Combine the original DataFrame and upsampled DataFrame to create the balanced DataFrame
-        balanced_df = pd.concat([self.df, upsampled_df], ignore_index=True)
-        self.df = balanced_df
+        try:
+            _dump_pickle((key, samples, caption_names), cache_path)
+        except OSError:
+            print(f"Couldn't write sample index to {cache_path}. Skipping.")
+
+        return samples, caption_names
+
+    def sample_key(self, name):
+        # (mtime_ns, size) of a sample's video and audio files. Raises OSError if either is missing.
+        video = os.stat(f"{self.data_dir}/video/{name}.mp4")
+        audio = os.stat(f"{self.data_dir}/audio/{name}.wav")
+        return video.st_mtime_ns, video.st_size, audio.st_mtime_ns, audio.st_size
+
+    def load_bad_videos(self):
+        # Each entry carries the sample_key it was recorded with, so it expires once either file is replaced.
+        bad_videos = set()
+        try:
+            with open(self.bad_videos_path, "r") as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) != 5: continue
+
+                    try:
+                        if self.sample_key(fields[0]) == tuple(int(field) for field in fields[1:]):
+                            bad_videos.add(fields[0])
+                    except (OSError, ValueError):
+                        continue
+        except OSError:
+            pass
+
+        return bad_videos
+
+    def save_bad_video(self, vid_path):
+        # One entry per line in append mode. Small appends don't interleave, so parallel workers can't drop entries.
+        name = os.path.basename(vid_path)[:-4]
+        try:
+            key = self.sample_key(name)
+            with open(self.bad_videos_path, "a") as file:
+                file.write(" ".join(str(field) for field in (name,) + key) + "\n")
+        except OSError:
+            print(f"Couldn't write bad video list to {self.bad_videos_path}. Skipping.")
+
+    def is_unreadable(self, vid_path):
+        # Whether the video or audio container itself can't be opened. That is deterministic, unlike
+        # a bad window draw or a transient I/O error, which must not blacklist a file. Missing files
+        # are not judged at all, since they may be mid-copy or on an unavailable mount.
+        aud_path = get_audio_path(vid_path)
+        if not (os.path.exists(vid_path) and os.path.exists(aud_path)):
+            return False
+
+        try:
+            probe_video_meta(vid_path)
+        except OSError:
+            return False
+        except Exception:
+            return True
+
+        try:
+            soundfile.info(aud_path)
+        except RuntimeError as e:
+            # libsndfile reports every open failure this way. "System error" means the OS call failed.
+            return "System error" not in str(e)
+        except Exception:
+            return False
+
+        return False
+
+    def reset_sample_masks(self):
+        # Per-index load results. _good_indices mirrors _known_good so resampling is O(1).
+        self._known_good = np.zeros(len(self.video_files), dtype=bool)
+        self._known_bad = np.zeros(len(self.video_files), dtype=bool)
+        self._failures = np.zeros(len(self.video_files), dtype=np.int64)
+        self._good_indices = []
+
+    def mark_failure(self, index):
+        # Only files that can't be opened at all are written to disk. Other failures, like a sampled
+        # window past the audio cap, stay in memory and only skip the index after repeated failures.
+        vid_path = self.video_files[index]
+        self._failures[index] += 1
+
+        if self.is_unreadable(vid_path):
+            self._known_bad[index] = True
+            self.save_bad_video(vid_path)
+        elif self._failures[index] >= self.max_load_failures:
+            self._known_bad[index] = True
+
+    def sample_retry_index(self):
+        if len(self._good_indices) > 0:
+            return self._good_indices[np.random.randint(len(self._good_indices))]
+
+        # Nothing has loaded yet, so try any index not already known to be bad.
+        candidates = np.flatnonzero(~self._known_bad)
+        if len(candidates) == 0:
+            raise RuntimeError(f"No loadable videos left in {self.data_dir}.")
+
+        return candidates[np.random.randint(len(candidates))]
 
     def prepare_dataset(self, samples):
         # self.up_sample()
         ytids = set(self.df['ytid'].unique().astype('str').tolist())
-        for vid in list(samples):
-            if vid[:11] in ytids:
-                self.video_files.append(os.path.join(f"{self.data_dir}/video/", vid + ".mp4"))
+        video_dir = f"{self.data_dir}/video/"
+        video_files = [os.path.join(video_dir, vid + ".mp4") for vid in samples if vid[:11] in ytids]
 
-    def get_frame_buckets(self, vr):
-        _, h, w = vr[0].shape        
-        width, height = sensible_buckets(self.width, self.height, h, w)
-        resize = T.transforms.Resize((height, width), antialias=True)
+        self._video_meta = self.load_video_meta(video_files)
+        self._checked_meta = set()
+        self.video_files.extend(vid_path for vid_path in video_files if vid_path in self._video_meta)
 
-        return resize
+    def load_video_meta(self, video_files):
+        # Frame count and fps are fixed per file, so probe them once and keep them next to the data.
+        # Entries are keyed by basename and store the file's (mtime_ns, size) when probed. Only new
+        # names are probed (and stat'ed) here; get_video_meta checks each file's freshness the first
+        # time it is sampled. Files that can't be probed are left out.
+        cache_path = f"{self.data_dir}/.video_meta.pkl"
 
-    def get_frame_batch(self, vr, resize=None):
+        try:
+            with open(cache_path, "rb") as file:
+                cached_meta = pickle.load(file)
+        except Exception:
+            cached_meta = {}
+
+        video_meta, missing = {}, 0
+        for vid_path in video_files:
+            name = os.path.basename(vid_path)
+            # Entries written before the (mtime_ns, size) key was stored are probed again.
+            if not isinstance(cached_meta.get(name, (None,))[0], tuple):
+                try:
+                    stat = os.stat(vid_path)
+                    cached_meta[name] = ((stat.st_mtime_ns, stat.st_size), probe_video_meta(vid_path))
+                    missing += 1
+                except Exception:
+                    print(f"Couldn't read video metadata for {vid_path}. Skipping.")
+                    continue
+
+            video_meta[vid_path] = cached_meta[name]
+
+        if missing > 0:
+            try:
+                _dump_pickle(cached_meta, cache_path)
+            except OSError:
+                print(f"Couldn't write video metadata to {cache_path}. Skipping.")
+
+        return video_meta
+
+    def get_video_meta(self, vr, vid_path):
+        # The first time a file is used, re-probe it if it changed since it was cached. The header's
+        # frame count can also differ from what the decoder can actually seek to, and indices past the
+        # real end fail to decode, so take the count from the reader or decoder that is opened anyway.
+        # PyAV keeps the header count, and decode_clip raises IndexError on an overshoot, which retries
+        # another index.
+        if vid_path not in self._checked_meta:
+            key, (num_frames, fps) = self._video_meta[vid_path]
+            stat = os.stat(vid_path)
+            if (stat.st_mtime_ns, stat.st_size) != key:
+                num_frames, fps = probe_video_meta(vid_path)
+
+            if vr is not None:
+                num_frames = len(vr)
+            elif self.decode_backend == 'torchcodec':
+                num_frames = len(_get_decoder(vid_path))
+
+            self._video_meta[vid_path] = (key, (num_frames, fps))
+            self._checked_meta.add(vid_path)
+
+        return self._video_meta[vid_path][1]
+
+    def get_frame_idxs(self, vr, vid_path):
         n_sample_frames = self.n_sample_frames
-        native_fps = vr.get_avg_fps()
+        num_frames, native_fps = self.get_video_meta(vr, vid_path)
 
         every_nth_frame = max(1, round((native_fps / self.fps) + 1e-5))
-        every_nth_frame = min(len(vr), every_nth_frame)
+        every_nth_frame = min(num_frames, every_nth_frame)
         
-        effective_length = len(vr) // every_nth_frame
+        effective_length = num_frames // every_nth_frame
         if effective_length < n_sample_frames:
             n_sample_frames = effective_length
-        try:
-            effective_idx = random.randint(0, (effective_length - (n_sample_frames*every_nth_frame) - 5))
-        except:
-            effective_idx = int(native_fps)
+
+        # Clips too short for a random start begin one second in.
+        max_start = effective_length - (n_sample_frames*every_nth_frame) - 5
+        effective_idx = random.randint(0, max_start) if max_start >= 0 else int(native_fps)
 
         idxs = every_nth_frame * np.arange(effective_idx, effective_idx + n_sample_frames)
 
+        if self.approximate_sampling and len(idxs) > 0:
+            idxs = self.snap_to_keyframe(vr if vr is not None else _get_vr(vid_path), idxs)
+
         if len(idxs) != n_sample_frames:
             idxs = np.tile(idxs, 10)[:n_sample_frames]
 
-        video = vr.get_batch(idxs)
-        video = rearrange(video, "f h w c -> f c h w")
+        return idxs
+
+    def snap_to_keyframe(self, vr, idxs):
+        # Start the clip on the closest keyframe at or before the requested start, keeping the spacing.
+        # The decoder can then seek straight to it instead of decoding frames that are thrown away.
+        key_idxs = np.asarray(vr.get_key_indices())
+        if len(key_idxs) == 0:
+            return idxs
+
+        pos = max(0, np.searchsorted(key_idxs, idxs[0], side='right') - 1)
+        return idxs - idxs[0] + key_idxs[pos]
 
-        if resize is not None: video = resize(video)
-        return (video, vr), idxs
-        
     def process_video_wrapper(self, vid_path):
-        video, vr, audio = process_video(
-                vid_path,
-                self.use_bucketing,
-                self.width, 
-                self.height, 
-                self.get_frame_buckets, 
-                self.get_frame_batch
-            )
-        return video, vr, audio
+        if self.decode_backend != 'decord':
+            # Frame count and fps come from the precomputed metadata, so no decord reader is opened
+            # (unless approximate_sampling needs decord's keyframe index).
+            idxs = self.get_frame_idxs(None, vid_path)
+            video = _decode_frames(vid_path, idxs, *self.get_frame_size(vid_path), backend=self.decode_backend)
+            audio = load_audio_window(get_audio_path(vid_path), idxs)
+
+            return video, None, audio
+
+        return super().process_video_wrapper(vid_path)
     
-    def get_prompt_ids(self, prompt):
-        return self.tokenizer(
-            prompt,
-            truncation=True,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            return_tensors="pt",
-        ).input_ids
+    def build_prompt_map(self, path, caption_names):
+        # Read the captions of the videos in use up front. Their names come from the list_samples index.
+        names = {os.path.basename(vid_path)[:-4] for vid_path in self.video_files} & caption_names
+        return {name: read_caption_file(f"{path}/video/{name}.txt") for name in names}
+
+    def get_video_prompt(self, vid_path):
+        ytid = os.path.basename(vid_path)[:-4]
+        return self._prompt_map.get(ytid, self.fallback_prompt)
 
     @staticmethod
     def __getname__(): return 'folder'
@@ -650,29 +1034,35 @@ class VideoFolderDataset(Dataset):
         return torch.Size([1, int(16000 * (self.n_sample_frames/self.fps))])
 
     def __getitem__(self, index):
+        # video_files can be extended after __init__ (see extend_datasets in train.py).
+        if len(self._known_good) != len(self.video_files):
+            self.reset_sample_masks()
 
         while True:
+            if self._known_bad[index]:
+                index = self.sample_retry_index()
+                continue
+
             try:
                 video, _, audio = self.process_video_wrapper(self.video_files[index])
-                assert video[0].size() == self.get_video_shape()
+                assert video.size() == self.get_video_shape()
                 assert audio.size() == self.get_audio_shape()
-                self.valid_videos.add(index)
+                if not self._known_good[index]:
+                    self._known_good[index] = True
+                    self._good_indices.append(index)
                 break
 
             except:
-                index = random.choice(list(self.valid_videos))
+                if not self._known_good[index]:
+                    self.mark_failure(index)
+                index = self.sample_retry_index()
 
         ytid = self.video_files[index].split('/')[-1][:-4]
 
-        if os.path.exists(self.video_files[index].replace(".mp4", ".txt")):
-            with open(self.video_files[index].replace(".mp4", ".txt"), "r") as f:
-                prompt = f.read()
-        else:
-            prompt = self.fallback_prompt
-
-        prompt_ids = self.get_prompt_ids(prompt)
+        prompt = self.get_video_prompt(self.video_files[index])
+        prompt_ids = get_cached_prompt_ids(self._prompt_cache, prompt, self.tokenizer)
 
-        return {"pixel_values": (video[0] / 127.5 - 1.0), "prompt_ids": prompt_ids[0], "text_prompt": prompt,
+        return {"pixel_values": normalize_frames(video), "prompt_ids": prompt_ids[0], "text_prompt": prompt,
                 'dataset': self.__getname__(), "audio_values": audio[0], 'ytid': ytid}
 
 
@@ -689,5 +1079,7 @@ class CachedDataset(Dataset):
         return len(self.cached_data_list)
 
     def __getitem__(self, index):
-        cached_latent = torch.load(self.cached_data_list[index], map_location='cuda:0')
-        return cached_latent
+        # Memory-map on the CPU so workers never touch CUDA. The DataLoader pins the result, and the
+        # accelerate-prepared loader copies it to the GPU with non_blocking=True (see main() in train.py).
+        cached_latent = torch.load(self.cached_data_list[index], map_location='cpu', mmap=True)
+        return dict(cached_latent)